@@ -1,13 +1,31 @@
 import argparse
 import boto3
+import functools
 import json
 import logging
 import re
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
 
 """
 Author: Benjamin Morris
 """
 
+# Upper bound on concurrent Organizations API calls.
+# Organizations throttles aggressively, so keep this small.
+MAX_WORKERS = 8
+
+@functools.lru_cache(maxsize=None)
+def wildcard_pattern(identifier):
+    """
+    Helper function that compiles a policy identifier containing "*" wildcards.
+
+    The same identifiers recur across statements and policies, so each one is
+    converted and compiled only once.
+    """
+    return re.compile(identifier.replace("*", ".*"))
+
+
 def check_conditions(condition, region, principal_arn, account, org_id):
     """
     Helper function that returns whether a condition applies.
@@ -32,7 +50,7 @@ def check_conditions(condition, region, principal_arn, account, org_id):
             # Operate under the assumption that the condition applies
             # unless an exception is found
             for excluded_principal in allowed_principals:
-                if re.search(excluded_principal.replace("*", ".*"), principal_arn):
+                if wildcard_pattern(excluded_principal).search(principal_arn):
                     return False
     except KeyError:
         logging.info("No principal allowlist condition found.")
@@ -44,7 +62,7 @@ def check_conditions(condition, region, principal_arn, account, org_id):
             # unless an exception is found
             applies = False
             for included_principal in blocked_principals:
-                if re.search(included_principal.replace("*", ".*"), principal_arn):
+                if wildcard_pattern(included_principal).search(principal_arn):
                     applies = True
             if applies is False:
                 return False
@@ -68,6 +86,44 @@ def check_conditions(condition, region, principal_arn, account, org_id):
     return True
 
 
+def get_policies_for_targets(org_client, targets):
+    """
+    Helper function that lists the SCPs attached to each target.
+
+    The per-target calls are independent of each other, so they are issued
+    concurrently. Results are returned in the same order as the targets.
+    """
+
+    paginator = org_client.get_paginator("list_policies_for_target")
+
+    def list_target_policies(target_id):
+        # Use the paginator so that policies past the first page are not dropped
+        return paginator.paginate(
+            TargetId=target_id, Filter="SERVICE_CONTROL_POLICY"
+        ).build_full_result()["Policies"]
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(list_target_policies, targets))
+
+
+def describe_policies(org_client, policy_ids):
+    """
+    Helper function that describes each unique policy exactly once.
+
+    The same SCP (e.g. FullAWSAccess) is usually attached at several levels
+    of the ancestry, so policies are fetched by ID rather than per attachment.
+
+    Returns a dict mapping policy ID to its Policy object.
+    """
+    unique_ids = list(dict.fromkeys(policy_ids))
+
+    def describe(policy_id):
+        return org_client.describe_policy(PolicyId=policy_id)["Policy"]
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return dict(zip(unique_ids, executor.map(describe, unique_ids)))
+
+
 def find_blocking_scp(
     # The account, OU ID, or root ID that you want to query
     target,
@@ -107,44 +163,59 @@ def find_blocking_scp(
         resource="arn:aws:logs:us-west-1:999999999999:log-group::log-stream:",
     )
     """
-    org_client = boto3.client("organizations")
+    org_client = boto3.client(
+        "organizations",
+        config=Config(
+            # One pooled connection per worker thread, so no thread waits on checkout
+            max_pool_connections=MAX_WORKERS,
+            retries={"max_attempts": 10, "mode": "adaptive"},
+        ),
+    )
     org_id = org_client.describe_organization()["Organization"]["Id"]
     current_target = target
     ou_stack = [current_target]
-    while not re.match(r"r-", current_target):
-        parent_resp = org_client.list_parents(ChildId=current_target)
-        parent_id = parent_resp["Parents"][0]["Id"]
-        ou_stack.append(parent_id)
-        current_target = parent_id
+    # Only the user-provided target needs its type inferred from the ID;
+    # list_parents already reports each parent's Type (ROOT or ORGANIZATIONAL_UNIT)
+    at_root = current_target.startswith("r-")
+    while not at_root:
+        parent = org_client.list_parents(ChildId=current_target)["Parents"][0]
+        ou_stack.append(parent["Id"])
+        current_target = parent["Id"]
+        at_root = parent["Type"] == "ROOT"
     logging.info(ou_stack)
     # Then for each layer, list the policies,
     # then describe the policies so that we can check for the specified action
-    for organizations_id in ou_stack:
-        policies = org_client.list_policies_for_target(
-            TargetId=organizations_id, Filter="SERVICE_CONTROL_POLICY"
-        )["Policies"]
+    policies_per_target = get_policies_for_targets(org_client, ou_stack)
+    policy_details = describe_policies(
+        org_client,
+        [policy["Id"] for policies in policies_per_target for policy in policies],
+    )
+    # Parse each unique policy once, even if it is attached at several levels
+    policy_statements = {
+        policy_id: json.loads(policy_response["Content"])["Statement"]
+        for policy_id, policy_response in policy_details.items()
+    }
+    for policies in policies_per_target:
         for policy in policies:
-            policy_id = policy["Id"]
-            policy_response = org_client.describe_policy(PolicyId=policy_id)
-            policy_content = policy_response["Policy"]["Content"]
-            policy_name = policy_response["Policy"]["PolicySummary"]["Name"]
-            policy_arn = policy_response["Policy"]["PolicySummary"]["Arn"]
+            policy_response = policy_details[policy["Id"]]
+            policy_content = policy_response["Content"]
+            policy_name = policy_response["PolicySummary"]["Name"]
+            policy_arn = policy_response["PolicySummary"]["Arn"]
             logging.warning(f"Querying policy {policy_name} (ARN {policy_arn})...")
             logging.debug(policy_content)
-            policy_json = json.loads(policy_content)["Statement"]
+            policy_json = policy_statements[policy["Id"]]
             for statement in policy_json:
                 if statement["Effect"] == "Deny":
 
                     # Check for Action value matches ###
+                    action_match = False
                     if statement.get("Action"):
-                        action_match = False
                         all_actions = statement["Action"]
                         # Standardize into a list if there's only one action
                         if isinstance(all_actions, str):
                             all_actions = [all_actions]
                         for action_identifier in all_actions:
-                            action_identifier = action_identifier.replace("*", ".*")
-                            if re.search(action_identifier, action):
+                            if wildcard_pattern(action_identifier).search(action):
                                 action_match = True
                                 break
                     elif statement.get("NotAction"):
@@ -154,12 +225,12 @@ def find_blocking_scp(
                         if isinstance(all_notactions, str):
                             all_notactions = [all_notactions]
                         for notaction_identifier in all_notactions:
-                            notaction_identifier = notaction_identifier.replace(
-                                "*", ".*"
-                            )
-                            if re.search(notaction_identifier, action):
+                            if wildcard_pattern(notaction_identifier).search(action):
                                 action_match = False
                                 break
+                    # No need to check resources or conditions if the action doesn't match
+                    if not action_match:
+                        continue
 
                     # Check for Resource value matches
                     resource_match = False
@@ -168,12 +239,15 @@ def find_blocking_scp(
                     if isinstance(all_resources, str):
                         all_resources = [all_resources]
                     for resource_identifier in all_resources:
-                        resource_identifier = resource_identifier.replace("*", ".*")
-                        if re.search(resource_identifier, resource):
+                        if wildcard_pattern(resource_identifier).search(resource):
                             resource_match = True
                             break
+                    if not resource_match:
+                        continue
 
                     # Check for Conditions (LIMITED FUNCTIONALITY!!!)
+                    # A statement without conditions always applies
+                    condition_match = True
                     try:
                         condition_json = statement["Condition"]
                         condition_match = check_conditions(
@@ -183,7 +257,7 @@ def find_blocking_scp(
                         logging.debug("No Conditions key in statement.")
 
                     # Filter out non-matching SCP statements
-                    if resource_match and action_match and condition_match:
+                    if condition_match:
                         pretty_statement = json.dumps(statement, indent=4)
                         logging.warning(
                             f"Found a possibly-blocking SCP in policy {policy_name}:\r\n{pretty_statement}"